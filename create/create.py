@@ -22,60 +22,53 @@ image artifacts.
 
 from __future__ import print_function
 
+from importlib import import_module
 import os
 import subprocess
 import sys
+import threading
+
+import six
 
 from acloud import errors
 from acloud.create import avd_spec
-from acloud.create import cheeps_remote_image_remote_instance
-from acloud.create import gce_local_image_remote_instance
-from acloud.create import gce_remote_image_remote_instance
-from acloud.create import goldfish_local_image_local_instance
-from acloud.create import goldfish_remote_image_remote_instance
-from acloud.create import local_image_local_instance
-from acloud.create import local_image_remote_instance
-from acloud.create import local_image_remote_host
-from acloud.create import remote_image_remote_instance
-from acloud.create import remote_image_local_instance
-from acloud.create import remote_image_remote_host
 from acloud.internal import constants
 from acloud.internal.lib import utils
-from acloud.setup import setup
-from acloud.setup import gcp_setup_runner
-from acloud.setup import host_setup_runner
 
 
 _MAKE_CMD = "build/soong/soong_ui.bash"
 _MAKE_ARG = "--make-mode"
+_CREATOR_PACKAGE = "acloud.create"
 
+# Creator modules pull in the cloud clients, so only the selected one gets
+# imported. The values are (module name, class name) in _CREATOR_PACKAGE.
 _CREATOR_CLASS_DICT = {
     # GCE types
     (constants.TYPE_GCE, constants.IMAGE_SRC_LOCAL, constants.INSTANCE_TYPE_REMOTE):
-        gce_local_image_remote_instance.GceLocalImageRemoteInstance,
+        ("gce_local_image_remote_instance", "GceLocalImageRemoteInstance"),
     (constants.TYPE_GCE, constants.IMAGE_SRC_REMOTE, constants.INSTANCE_TYPE_REMOTE):
-        gce_remote_image_remote_instance.GceRemoteImageRemoteInstance,
+        ("gce_remote_image_remote_instance", "GceRemoteImageRemoteInstance"),
     # CF types
     (constants.TYPE_CF, constants.IMAGE_SRC_LOCAL, constants.INSTANCE_TYPE_LOCAL):
-        local_image_local_instance.LocalImageLocalInstance,
+        ("local_image_local_instance", "LocalImageLocalInstance"),
     (constants.TYPE_CF, constants.IMAGE_SRC_LOCAL, constants.INSTANCE_TYPE_REMOTE):
-        local_image_remote_instance.LocalImageRemoteInstance,
+        ("local_image_remote_instance", "LocalImageRemoteInstance"),
     (constants.TYPE_CF, constants.IMAGE_SRC_LOCAL, constants.INSTANCE_TYPE_HOST):
-        local_image_remote_host.LocalImageRemoteHost,
+        ("local_image_remote_host", "LocalImageRemoteHost"),
     (constants.TYPE_CF, constants.IMAGE_SRC_REMOTE, constants.INSTANCE_TYPE_REMOTE):
-        remote_image_remote_instance.RemoteImageRemoteInstance,
+        ("remote_image_remote_instance", "RemoteImageRemoteInstance"),
     (constants.TYPE_CF, constants.IMAGE_SRC_REMOTE, constants.INSTANCE_TYPE_LOCAL):
-        remote_image_local_instance.RemoteImageLocalInstance,
+        ("remote_image_local_instance", "RemoteImageLocalInstance"),
     (constants.TYPE_CF, constants.IMAGE_SRC_REMOTE, constants.INSTANCE_TYPE_HOST):
-        remote_image_remote_host.RemoteImageRemoteHost,
+        ("remote_image_remote_host", "RemoteImageRemoteHost"),
     # Cheeps types
     (constants.TYPE_CHEEPS, constants.IMAGE_SRC_REMOTE, constants.INSTANCE_TYPE_REMOTE):
-        cheeps_remote_image_remote_instance.CheepsRemoteImageRemoteInstance,
+        ("cheeps_remote_image_remote_instance", "CheepsRemoteImageRemoteInstance"),
     # GF types
     (constants.TYPE_GF, constants.IMAGE_SRC_REMOTE, constants.INSTANCE_TYPE_REMOTE):
-        goldfish_remote_image_remote_instance.GoldfishRemoteImageRemoteInstance,
+        ("goldfish_remote_image_remote_instance", "GoldfishRemoteImageRemoteInstance"),
     (constants.TYPE_GF, constants.IMAGE_SRC_LOCAL, constants.INSTANCE_TYPE_LOCAL):
-        goldfish_local_image_local_instance.GoldfishLocalImageLocalInstance,
+        ("goldfish_local_image_local_instance", "GoldfishLocalImageLocalInstance"),
 }
 
 
@@ -96,14 +89,15 @@ def GetAvdCreatorClass(avd_type, instance_type, image_source):
     Raises:
         UnsupportedInstanceImageType if argments didn't match _CREATOR_CLASS_DICT.
     """
-    creator_class = _CREATOR_CLASS_DICT.get(
-        (avd_type, image_source, instance_type))
-
-    if not creator_class:
+    try:
+        module_name, class_name = _CREATOR_CLASS_DICT[
+            (avd_type, image_source, instance_type)]
+    except KeyError:
         raise errors.UnsupportedInstanceImageType(
             "unsupported creation of avd type: %s, instance type: %s, "
             "image source: %s" % (avd_type, instance_type, image_source))
-    return creator_class
+    creator_module = import_module("%s.%s" % (_CREATOR_PACKAGE, module_name))
+    return getattr(creator_module, class_name)
 
 def _CheckForAutoconnect(args):
     """Check that we have all prerequisites for autoconnect.
@@ -151,6 +145,40 @@ def _CheckForAutoconnect(args):
         args.autoconnect = False
 
 
+def _RunConcurrently(checks):
+    """Run the checks in parallel threads and collect their results.
+
+    Args:
+        checks: List of functions without args.
+
+    Returns:
+        List of the results of checks, in the same order.
+
+    Raises:
+        The exception raised by the first failed check.
+    """
+    results = [None] * len(checks)
+    exc_infos = [None] * len(checks)
+
+    def _RunCheck(index):
+        """Run one check and store its result or exception."""
+        try:
+            results[index] = checks[index]()
+        except Exception:  # pylint: disable=broad-except
+            exc_infos[index] = sys.exc_info()
+
+    threads = [threading.Thread(target=_RunCheck, args=(index,))
+               for index in range(len(checks))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for exc_info in exc_infos:
+        if exc_info:
+            six.reraise(*exc_info)
+    return results
+
+
 def _CheckForSetup(args):
     """Check that host is setup to run the create commands.
 
@@ -160,17 +188,24 @@ def _CheckForSetup(args):
     Args:
         args: Namespace object from argparse.parse_args.
     """
+    # The setup modules are imported only on the paths that need them, they
+    # are heavy and setup rarely has to run.
+    from acloud.setup import host_setup_runner
+
     # Need to set all these so if we need to run setup, it won't barf on us
     # because of some missing fields.
     args.gcp_init = False
     args.host = False
     args.host_base = False
     args.force = False
+    # The checks read the config and query the package manager, so they are
+    # run in parallel. Each one maps to the args field to set if it's needed.
+    checks = []
     # Remote image/instance requires the GCP config setup.
     if not args.local_instance or args.local_image == "":
-        gcp_setup = gcp_setup_runner.GcpTaskRunner(args.config_file)
-        if gcp_setup.ShouldRun():
-            args.gcp_init = True
+        from acloud.setup import gcp_setup_runner
+        checks.append(("gcp_init", lambda: gcp_setup_runner.GcpTaskRunner(
+            args.config_file).ShouldRun()))
 
     # Local instance requires host to be setup. We'll assume that if the
     # packages were installed, then the user was added into the groups. This
@@ -179,14 +214,16 @@ def _CheckForSetup(args):
     # through the whole setup again even though it's already done because the
     # user groups aren't set until the user logs out and back in.
     if args.local_instance:
-        host_pkg_setup = host_setup_runner.AvdPkgInstaller()
-        if host_pkg_setup.ShouldRun():
-            args.host = True
+        checks.append(("host", lambda: host_setup_runner.AvdPkgInstaller().ShouldRun()))
 
     # Install base packages if we haven't already.
-    host_base_setup = host_setup_runner.HostBasePkgInstaller()
-    if host_base_setup.ShouldRun():
-        args.host_base = True
+    checks.append(("host_base",
+                   lambda: host_setup_runner.HostBasePkgInstaller().ShouldRun()))
+
+    should_run = _RunConcurrently([check for _, check in checks])
+    for (arg_name, _), needed in zip(checks, should_run):
+        if needed:
+            setattr(args, arg_name, True)
 
     run_setup = args.force or args.gcp_init or args.host or args.host_base
 
@@ -194,6 +231,7 @@ def _CheckForSetup(args):
         answer = utils.InteractWithQuestion("Missing necessary acloud setup, "
                                             "would you like to run setup[y/N]?")
         if answer in constants.USER_ANSWER_YES:
+            from acloud.setup import setup
             setup.Run(args)
         else:
             print("Please run '#acloud setup' so we can get your host setup")
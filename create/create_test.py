@@ -78,6 +78,14 @@ class CreateTest(driver_test_lib.BaseDriverTest):
         create._CheckForAutoconnect(args)
         self.assertEqual(args.autoconnect, False)
 
+    # pylint: disable=protected-access
+    def testRunConcurrently(self):
+        """Test _RunConcurrently returns results in order and raises errors."""
+        self.assertEqual(create._RunConcurrently([lambda: 1, lambda: 2]), [1, 2])
+        failed_check = mock.MagicMock(side_effect=errors.SetupError("fake error"))
+        with self.assertRaises(errors.SetupError):
+            create._RunConcurrently([lambda: 1, failed_check])
+
     # pylint: disable=protected-access,no-member
     def testCheckForSetup(self):
         """Test _CheckForSetup."""
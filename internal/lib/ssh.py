@@ -13,11 +13,19 @@
 # limitations under the License.
 """Ssh Utilities."""
 from __future__ import print_function
+import errno
 import logging
-
+import os
+import select
+import shlex
+import stat
 import subprocess
 import sys
+import tempfile
 import threading
+import time
+
+import six
 
 from acloud import errors
 from acloud.internal import constants
@@ -26,11 +34,54 @@ from acloud.internal.lib import utils
 logger = logging.getLogger(__name__)
 
 _SSH_CMD = ("-i %(rsa_key_file)s "
-            "-q -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no")
+            "-q -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no "
+            "%(control_opts)s")
+# Share one authenticated connection per target between ssh/scp calls. The
+# sockets live in a private dir, the one in home is used if the dir in /tmp
+# isn't ours.
+_SSH_CONTROL_DIR = os.path.join(tempfile.gettempdir(),
+                                "acloud_ssh_%d" % os.getuid())
+_SSH_FALLBACK_CONTROL_DIR = os.path.join(os.path.expanduser("~"), ".config",
+                                         "acloud", "ssh")
+_SSH_CONTROL_OPTS = ("-o ControlMaster=auto -o ControlPath=%(control_path)s "
+                     "-o ControlPersist=120s")
 _SSH_IDENTITY = "-l %(login_user)s %(ip_addr)s"
 _SSH_CMD_MAX_RETRY = 5
 _SSH_CMD_RETRY_SLEEP = 3
 _WAIT_FOR_SSH_MAX_TIMEOUT = 60
+_WAIT_FOR_SSH_GRACE_SECS = 5
+_READ_BUFFER_SIZE = 65536
+# Keep batched scp commands well below the kernel's argument size limit.
+_SCP_MAX_CMD_LENGTH = 100000
+# Limit concurrent connection attempts to each target to stay below sshd's
+# MaxStartups. The semaphores are keyed by the target ip.
+_MAX_CONCURRENT_CONNECTS = 8
+_CONNECT_SEMAPHORES = {}
+_CONNECT_SEMAPHORES_LOCK = threading.Lock()
+_SEMAPHORE_POLL_SECS = 0.1
+
+
+def _SplitArgs(args, reserved_length):
+    """Split args into batches that keep each command short enough.
+
+    Args:
+        args: List of strings, the args to split.
+        reserved_length: Integer, length of the rest of the command.
+
+    Yields:
+        Lists of strings, the batches of args.
+    """
+    batch = []
+    batch_length = reserved_length
+    for arg in args:
+        if batch and batch_length + len(arg) + 1 > _SCP_MAX_CMD_LENGTH:
+            yield batch
+            batch = []
+            batch_length = reserved_length
+        batch.append(arg)
+        batch_length += len(arg) + 1
+    if batch:
+        yield batch
 
 
 def _SshCallWait(cmd, timeout=None):
@@ -41,52 +92,143 @@ def _SshCallWait(cmd, timeout=None):
 
     Args:
         cmd: String of the full SSH command to run, including the SSH binary
-             and its arguments.
+             and its arguments. A list of the args runs it without a shell.
         timeout: Optional integer, number of seconds to give
 
     Returns:
         An exit status of 0 indicates that it ran successfully.
     """
-    logger.info("Running command \"%s\"", cmd)
-    process = subprocess.Popen(cmd, shell=True, stdin=None,
+    shell = isinstance(cmd, six.string_types)
+    logger.info("Running command \"%s\"", cmd if shell else " ".join(cmd))
+    process = subprocess.Popen(cmd, shell=shell, stdin=None,
                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if timeout:
-        # TODO: if process is killed, out error message to log.
-        timer = threading.Timer(timeout, process.kill)
-        timer.start()
-    process.wait()
-    if timeout:
-        timer.cancel()
+    _WaitWithTimeout(process, process.wait, timeout)
     return process.returncode
 
 
+def _WaitWithTimeout(process, wait_method, timeout=None):
+    """Wait for the process to complete and kill it if it runs too long.
+
+    Python 3 blocks in the wait method until the timeout expires. Python 2 has
+    no timeout argument, so a timer thread kills the process instead.
+
+    Args:
+        process: A subprocess.Popen object.
+        wait_method: The method of process to wait with, process.wait or
+                     process.communicate.
+        timeout: Optional integer, number of seconds to give.
+
+    Returns:
+        The return value of wait_method.
+    """
+    if six.PY2:
+        if timeout:
+            # TODO: if process is killed, out error message to log.
+            timer = threading.Timer(timeout, process.kill)
+            timer.start()
+        result = wait_method()
+        if timeout:
+            timer.cancel()
+        return result
+
+    try:
+        return wait_method(timeout=timeout)
+    except subprocess.TimeoutExpired:  # pylint: disable=no-member
+        logger.debug("Command timed out after %s secs, killing it.", timeout)
+        process.kill()
+        return wait_method()
+
+
 def _SshCall(cmd, timeout=None):
     """Runs a single SSH command.
 
     - SSH returns code 0 for "Successful execution".
-    - Use communicate() until the process and the child thread are complete.
+    - Use communicate() until the process is complete or the timeout expires.
 
     Args:
         cmd: String of the full SSH command to run, including the SSH binary
-             and its arguments.
+             and its arguments. A list of the args runs it without a shell.
         timeout: Optional integer, number of seconds to give
 
     Returns:
         An exit status of 0 indicates that it ran successfully.
     """
-    logger.info("Running command \"%s\"", cmd)
-    process = subprocess.Popen(cmd, shell=True, stdin=None,
+    shell = isinstance(cmd, six.string_types)
+    logger.info("Running command \"%s\"", cmd if shell else " ".join(cmd))
+    process = subprocess.Popen(cmd, shell=shell, stdin=None,
                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if timeout:
-        # TODO: if process is killed, out error message to log.
-        timer = threading.Timer(timeout, process.kill)
-        timer.start()
-    process.communicate()
-    if timeout:
-        timer.cancel()
+    _WaitWithTimeout(process, process.communicate, timeout)
     return process.returncode
 
 
+def _IsDebugLogged(target_logger):
+    """Check if any handler would emit the debug logs of the logger.
+
+    The logger level alone doesn't tell, acloud sets its loggers to debug and
+    filters by the handler levels.
+
+    Args:
+        target_logger: A logging.Logger object.
+
+    Returns:
+        Boolean, True if a handler of the logger or its ancestors handles
+        debug logs.
+    """
+    if not target_logger.isEnabledFor(logging.DEBUG):
+        return False
+    current_logger = target_logger
+    while current_logger:
+        for handler in current_logger.handlers:
+            if handler.level <= logging.DEBUG:
+                return True
+        if not current_logger.propagate:
+            break
+        current_logger = current_logger.parent
+    return False
+
+
+def _ReadOutput(process, log_lines=False, timeout=None):
+    """Read the process output in chunks until the process closes it.
+
+    Args:
+        process: A subprocess.Popen object with stdout piped.
+        log_lines: Boolean, True to log each complete line at the debug level
+                   as soon as it's read.
+        timeout: Optional integer, number of seconds to give. The process is
+                 killed if it's still writing output after that.
+
+    Returns:
+        String of the whole process output.
+    """
+    output = []
+    partial_line = b""
+    stdout_fd = process.stdout.fileno()
+    deadline = time.time() + timeout if timeout else None
+    while True:
+        if deadline is not None:
+            ready, _, _ = select.select(
+                [stdout_fd], [], [], max(deadline - time.time(), 0))
+            if not ready:
+                logger.debug("Command timed out after %s secs, killing it.",
+                             timeout)
+                process.kill()
+                # Read whatever is left until the killed process closes it.
+                deadline = None
+        chunk = os.read(stdout_fd, _READ_BUFFER_SIZE)
+        if not chunk:
+            break
+        output.append(chunk)
+        if log_lines:
+            lines = (partial_line + chunk).split(b"\n")
+            partial_line = lines.pop()
+            for line in lines:
+                logger.debug(line)
+    if log_lines and partial_line:
+        logger.debug(partial_line)
+    process.stdout.close()
+    return b"".join(output)
+
+
 def _SshLogOutput(cmd, timeout=None, show_output=False):
     """Runs a single SSH command while logging its output and processes its return code.
 
@@ -97,6 +239,7 @@ def _SshLogOutput(cmd, timeout=None, show_output=False):
 
     Args:
         cmd: String of the full SSH command to run, including the SSH binary and its arguments.
+             A list of the args runs it without a shell.
         timeout: Optional integer, number of seconds to give.
         show_output: Boolean, True to show command output in screen.
 
@@ -104,25 +247,21 @@ def _SshLogOutput(cmd, timeout=None, show_output=False):
         errors.DeviceConnectionError: Failed to connect to the GCE instance.
         subprocess.CalledProc: The process exited with an error on the instance.
     """
-    # Use "exec" to let cmd to inherit the shell process, instead of having the
-    # shell launch a child process which does not get killed.
-    cmd = "exec " + cmd
-    logger.info("Running command \"%s\"", cmd)
-    process = subprocess.Popen(cmd, shell=True, stdin=None,
+    shell = isinstance(cmd, six.string_types)
+    if shell:
+        # Use "exec" to let cmd to inherit the shell process, instead of having the
+        # shell launch a child process which does not get killed.
+        cmd = "exec " + cmd
+    logger.info("Running command \"%s\"", cmd if shell else " ".join(cmd))
+    process = subprocess.Popen(cmd, shell=shell, stdin=None,
                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if timeout:
-        # TODO: if process is killed, out error message to log.
-        timer = threading.Timer(timeout, process.kill)
-        timer.start()
-    stdout, _ = process.communicate()
-    if stdout:
-        if show_output or process.returncode != 0:
-            print(stdout.strip(), file=sys.stderr)
-        else:
-            # fetch_cvd and launch_cvd can be noisy, so left at debug
-            logger.debug(stdout.strip())
-    if timeout:
-        timer.cancel()
+    # fetch_cvd and launch_cvd can be noisy, so left at debug. Skip splitting
+    # the output into lines if no handler would emit them.
+    log_lines = not show_output and _IsDebugLogged(logger)
+    output = _ReadOutput(process, log_lines=log_lines, timeout=timeout)
+    process.wait()
+    if output and (show_output or process.returncode != 0):
+        print(output.strip(), file=sys.stderr)
     if process.returncode == 255:
         raise errors.DeviceConnectionError(
             "Failed to send command to instance (%s)" % cmd)
@@ -140,6 +279,7 @@ def ShellCmdWithRetry(cmd, timeout=None, show_output=False):
 
     Args:
         cmd: String of the full SSH command to run, including the SSH binary and its arguments.
+             A list of the args runs it without a shell.
         timeout: Optional integer, number of seconds to give.
         show_output: Boolean, True to show command output in screen.
 
@@ -158,6 +298,90 @@ def ShellCmdWithRetry(cmd, timeout=None, show_output=False):
         show_output=show_output)
 
 
+def _IsPrivateDir(dir_path):
+    """Create the dir if needed and check only the current user can use it.
+
+    Args:
+        dir_path: String, path of the dir.
+
+    Returns:
+        Boolean, True if the dir is a real dir owned by the current user with
+        mode 0700.
+    """
+    try:
+        os.makedirs(dir_path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            logger.debug("Failed to create %s: %s", dir_path, e)
+            return False
+    try:
+        dir_stat = os.lstat(dir_path)
+    except OSError as e:
+        logger.debug("Failed to check %s: %s", dir_path, e)
+        return False
+    return (stat.S_ISDIR(dir_stat.st_mode)
+            and dir_stat.st_uid == os.getuid()
+            and stat.S_IMODE(dir_stat.st_mode) == 0o700)
+
+
+def _GetControlPath():
+    """Get the ControlPath for the ssh master connections.
+
+    Returns:
+        String of the ControlPath, None if there's no private dir to keep the
+        sockets in.
+    """
+    for control_dir in (_SSH_CONTROL_DIR, _SSH_FALLBACK_CONTROL_DIR):
+        if _IsPrivateDir(control_dir):
+            return os.path.join(control_dir, "%C")
+        logger.debug("%s isn't a private dir, skip it.", control_dir)
+    logger.warning("No private dir for ssh control sockets, ssh connections "
+                   "won't be shared.")
+    return None
+
+
+def _GetConnectSemaphore(ip):
+    """Get the semaphore limiting concurrent connection attempts to the ip.
+
+    Args:
+        ip: String of the target ip.
+
+    Returns:
+        A threading.BoundedSemaphore object.
+    """
+    with _CONNECT_SEMAPHORES_LOCK:
+        if ip not in _CONNECT_SEMAPHORES:
+            _CONNECT_SEMAPHORES[ip] = threading.BoundedSemaphore(
+                _MAX_CONCURRENT_CONNECTS)
+        return _CONNECT_SEMAPHORES[ip]
+
+
+def _AcquireWithTimeout(semaphore, timeout=None):
+    """Acquire the semaphore, giving up once the timeout expires.
+
+    Python 2 has no timeout argument for acquire(), so it polls instead.
+
+    Args:
+        semaphore: A threading.BoundedSemaphore object.
+        timeout: Optional number of seconds to give, None to block until
+                 it's acquired.
+
+    Returns:
+        Boolean, True if the semaphore is acquired.
+    """
+    if timeout is None:
+        return semaphore.acquire()
+    if not six.PY2:
+        return semaphore.acquire(timeout=max(timeout, 0))
+    deadline = time.time() + timeout
+    while not semaphore.acquire(False):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(remaining, _SEMAPHORE_POLL_SECS))
+    return True
+
+
 class IP(object):
     """ A class that control the IP address."""
     def __init__(self, external=None, internal=None, ip=None):
@@ -180,6 +404,9 @@ class Ssh(object):
         _user: String of user login into the instance.
         _ssh_private_key_path: Path to the private key file.
         _extra_args_ssh_tunnel: String, extra args for ssh or scp.
+        _control_path: String of the ControlPath, None to not share the
+                       connection.
+        _base_cmds: Dict of execute bin to its base connection command.
     """
     def __init__(self, ip, user, ssh_private_key_path,
                  extra_args_ssh_tunnel=None, report_internal_ip=False):
@@ -187,6 +414,8 @@ class Ssh(object):
         self._user = user
         self._ssh_private_key_path = ssh_private_key_path
         self._extra_args_ssh_tunnel = extra_args_ssh_tunnel
+        self._control_path = _GetControlPath()
+        self._base_cmds = {}
 
     def Run(self, target_command, timeout=None, show_output=False):
         """Run a shell command over SSH on a remote instance.
@@ -208,51 +437,96 @@ class Ssh(object):
                           timeout,
                           show_output)
 
-    def GetBaseCmd(self, execute_bin):
-        """Get a base command over SSH on a remote instance.
+    def _BuildBaseCmd(self, execute_bin):
+        """Build a base command over SSH on a remote instance.
 
         Example:
             execute bin is ssh:
-                ssh -i ~/private_key_path $extra_args -l user 1.1.1.1
+                ssh -i ~/private_key_path $control_opts $extra_args -l user 1.1.1.1
             execute bin is scp:
-                scp -i ~/private_key_path $extra_args
+                scp -i ~/private_key_path $control_opts $extra_args
 
         Args:
             execute_bin: String, execute type, e.g. ssh or scp.
 
         Returns:
             Strings of base connection command.
-
-        Raises:
-            errors.UnknownType: Don't support the execute bin.
         """
+        control_opts = ""
+        if self._control_path:
+            control_opts = _SSH_CONTROL_OPTS % {"control_path": self._control_path}
         base_cmd = [utils.FindExecutable(execute_bin)]
-        base_cmd.append(_SSH_CMD % {"rsa_key_file": self._ssh_private_key_path})
+        base_cmd.append((_SSH_CMD % {
+            "rsa_key_file": self._ssh_private_key_path,
+            "control_opts": control_opts}).strip())
         if self._extra_args_ssh_tunnel:
             base_cmd.append(self._extra_args_ssh_tunnel)
 
         if execute_bin == constants.SSH_BIN:
             base_cmd.append(_SSH_IDENTITY %
                             {"login_user":self._user, "ip_addr":self._ip})
-            return " ".join(base_cmd)
-        if execute_bin == constants.SCP_BIN:
-            return " ".join(base_cmd)
+        return " ".join(base_cmd)
+
+    def GetBaseCmd(self, execute_bin):
+        """Get a base command over SSH on a remote instance.
+
+        Args:
+            execute_bin: String, execute type, e.g. ssh or scp.
+
+        Returns:
+            Strings of base connection command.
+
+        Raises:
+            errors.UnknownType: Don't support the execute bin.
+        """
+        if execute_bin not in (constants.SSH_BIN, constants.SCP_BIN):
+            raise errors.UnknownType("Don't support the execute bin %s." % execute_bin)
+        # The connection args never change, so only build the command once.
+        if execute_bin not in self._base_cmds:
+            self._base_cmds[execute_bin] = self._BuildBaseCmd(execute_bin)
+        return self._base_cmds[execute_bin]
+
+    def _GetBaseCmdArgs(self, execute_bin):
+        """Get the base command split into args to run it without a shell.
 
-        raise errors.UnknownType("Don't support the execute bin %s." % execute_bin)
+        Args:
+            execute_bin: String, execute type, e.g. ssh or scp.
+
+        Returns:
+            List of strings, the base connection command args.
+        """
+        return shlex.split(self.GetBaseCmd(execute_bin))
 
     def CheckSshConnection(self, timeout):
         """Run remote 'uptime' ssh command to check ssh connection.
 
+        The time waiting for other connection attempts to the same target is
+        counted in the timeout.
+
         Args:
             timeout: Integer, the maximum time to wait for the command to respond.
 
         Raises:
             errors.DeviceConnectionError: Ssh isn't ready in the remote instance.
         """
-        remote_cmd = [self.GetBaseCmd(constants.SSH_BIN)]
+        remote_cmd = self._GetBaseCmdArgs(constants.SSH_BIN)
         remote_cmd.append("uptime")
 
-        if _SshCallWait(" ".join(remote_cmd), timeout) == 0:
+        start_time = time.time()
+        semaphore = _GetConnectSemaphore(self._ip)
+        if not _AcquireWithTimeout(semaphore, timeout):
+            raise errors.DeviceConnectionError(
+                "Timed out waiting for other connections to %s." % self._ip)
+        try:
+            if timeout:
+                timeout -= time.time() - start_time
+                if timeout <= 0:
+                    raise errors.DeviceConnectionError(
+                        "Timed out waiting for other connections to %s." % self._ip)
+            returncode = _SshCallWait(remote_cmd, timeout)
+        finally:
+            semaphore.release()
+        if returncode == 0:
             return
         raise errors.DeviceConnectionError(
             "Ssh isn't ready in the remote instance.")
@@ -262,6 +536,11 @@ class Ssh(object):
                    max_retry=_SSH_CMD_MAX_RETRY):
         """Wait until the remote instance is ready to accept commands over SSH.
 
+        At most max_retry + 1 probes are started. A failed probe is retried
+        after a linear backoff, and a probe still running after half its
+        timeout is overlapped with the next one instead of being waited out.
+        The first probe that connects ends the wait.
+
         Args:
             timeout: Integer, the maximum time in seconds to wait for the
                      command to respond.
@@ -272,13 +551,63 @@ class Ssh(object):
             errors.DeviceConnectionError: Ssh isn't ready in the remote instance.
         """
         timeout_one_round = timeout / max_retry if timeout else None
-        utils.RetryExceptionType(
-            exception_types=errors.DeviceConnectionError,
-            max_retries=max_retry,
-            functor=self.CheckSshConnection,
-            sleep_multiplier=sleep_for_retry,
-            retry_backoff_factor=utils.DEFAULT_RETRY_BACKOFF_FACTOR,
-            timeout=timeout_one_round or _WAIT_FOR_SSH_MAX_TIMEOUT)
+        probe_timeout = timeout_one_round or _WAIT_FOR_SSH_MAX_TIMEOUT
+        total_probes = max_retry + 1
+        probe_results = six.moves.queue.Queue()
+
+        def _Probe(index):
+            """Put (index, True) into probe_results if ssh is ready.
+
+            Failures are put as (index, False), and unexpected errors as
+            (index, exc_info) for the caller to raise.
+            """
+            try:
+                self.CheckSshConnection(probe_timeout)
+                probe_results.put((index, True))
+            except errors.DeviceConnectionError:
+                probe_results.put((index, False))
+            except Exception:  # pylint: disable=broad-except
+                probe_results.put((index, sys.exc_info()))
+
+        started_probes = 0
+        running_probes = 0
+        next_probe_time = time.time()
+        last_probe_end_time = None
+        while True:
+            now = time.time()
+            if started_probes < total_probes and now >= next_probe_time:
+                probe = threading.Thread(target=_Probe, args=(started_probes,))
+                probe.daemon = True
+                probe.start()
+                started_probes += 1
+                running_probes += 1
+                next_probe_time = now + probe_timeout / 2.0
+                last_probe_end_time = now + probe_timeout
+            if started_probes < total_probes:
+                wait_until = next_probe_time
+            elif running_probes:
+                # Give the probes a grace period to report after their timeout.
+                wait_until = last_probe_end_time + _WAIT_FOR_SSH_GRACE_SECS
+            else:
+                break
+            try:
+                index, result = probe_results.get(
+                    timeout=max(wait_until - time.time(), 0))
+            except six.moves.queue.Empty:
+                if started_probes == total_probes and time.time() >= wait_until:
+                    break
+                continue
+            running_probes -= 1
+            if isinstance(result, tuple):
+                six.reraise(*result)
+            if result:
+                return
+            if index == started_probes - 1:
+                # The latest probe failed, retry after the backoff.
+                next_probe_time = min(next_probe_time,
+                                      time.time() + sleep_for_retry * started_probes)
+        raise errors.DeviceConnectionError(
+            "Ssh isn't ready in the remote instance.")
 
     def ScpPushFile(self, src_file, dst_file):
         """Scp push file to remote.
@@ -287,10 +616,21 @@ class Ssh(object):
             src_file: The source file path to be pulled.
             dst_file: The destination file path the file is pulled to.
         """
-        scp_command = [self.GetBaseCmd(constants.SCP_BIN)]
-        scp_command.append(src_file)
-        scp_command.append("%s@%s:%s" %(self._user, self._ip, dst_file))
-        ShellCmdWithRetry(" ".join(scp_command))
+        self.ScpPushFiles([src_file], dst_file)
+
+    def ScpPushFiles(self, src_files, dst_dir):
+        """Scp push files to remote with as few scp commands as possible.
+
+        Args:
+            src_files: List of the source file paths to be pushed.
+            dst_dir: The destination dir path the files are pushed to. It can
+                     also be the destination file path of a single file.
+        """
+        scp_base = self._GetBaseCmdArgs(constants.SCP_BIN)
+        remote_dst = "%s@%s:%s" % (self._user, self._ip, dst_dir)
+        reserved_length = len(" ".join(scp_base + [remote_dst]))
+        for batch in _SplitArgs(src_files, reserved_length):
+            ShellCmdWithRetry(scp_base + batch + [remote_dst])
 
     def ScpPullFile(self, src_file, dst_file):
         """Scp pull file from remote.
@@ -299,7 +639,19 @@ class Ssh(object):
             src_file: The source file path to be pulled.
             dst_file: The destination file path the file is pulled to.
         """
-        scp_command = [self.GetBaseCmd(constants.SCP_BIN)]
-        scp_command.append("%s@%s:%s" %(self._user, self._ip, src_file))
-        scp_command.append(dst_file)
-        ShellCmdWithRetry(" ".join(scp_command))
+        self.ScpPullFiles([src_file], dst_file)
+
+    def ScpPullFiles(self, src_files, dst_dir):
+        """Scp pull files from remote with as few scp commands as possible.
+
+        Args:
+            src_files: List of the source file paths to be pulled.
+            dst_dir: The destination dir path the files are pulled to. It can
+                     also be the destination file path of a single file.
+        """
+        scp_base = self._GetBaseCmdArgs(constants.SCP_BIN)
+        remote_srcs = ["%s@%s:%s" % (self._user, self._ip, src_file)
+                       for src_file in src_files]
+        reserved_length = len(" ".join(scp_base + [dst_dir]))
+        for batch in _SplitArgs(remote_srcs, reserved_length):
+            ShellCmdWithRetry(scp_base + batch + [dst_dir])
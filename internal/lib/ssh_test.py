@@ -16,7 +16,15 @@
 
 """Tests for acloud.internal.lib.ssh."""
 
+import errno
+import logging
+import os
+import select
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 import unittest
 import mock
 
@@ -38,6 +46,9 @@ class SshTest(driver_test_lib.BaseDriverTest):
     def setUp(self):
         """Set up the test."""
         super(SshTest, self).setUp()
+        self._get_control_path = ssh._GetControlPath
+        self.Patch(ssh, "_GetControlPath", return_value="/fake/acloud_ssh/%C")
+        self.Patch(os, "makedirs")
         self.created_subprocess = mock.MagicMock()
         self.created_subprocess.stdout = mock.MagicMock()
         self.created_subprocess.stdout.readline = mock.MagicMock(return_value='')
@@ -45,6 +56,7 @@ class SshTest(driver_test_lib.BaseDriverTest):
         self.created_subprocess.returncode = 0
         self.created_subprocess.communicate = mock.MagicMock(return_value=
                                                              ('', ''))
+        self.Patch(os, "read", return_value=b"")
 
     def testSSHExecuteWithRetry(self):
         """test SSHExecuteWithRetry method."""
@@ -55,6 +67,115 @@ class SshTest(driver_test_lib.BaseDriverTest):
                           ssh.ShellCmdWithRetry,
                           "fake cmd")
 
+    # pylint: disable=protected-access
+    def testSshCall(self):
+        """Test _SshCall returns the exit status of the command."""
+        self.Patch(subprocess, "Popen", return_value=self.created_subprocess)
+        self.assertEqual(ssh._SshCall("fake cmd", timeout=1), 0)
+        self.created_subprocess.communicate.assert_called()
+
+    # pylint: disable=protected-access
+    def testReadOutput(self):
+        """Test _ReadOutput joins the chunks and logs complete lines."""
+        self.Patch(os, "read", side_effect=[b"line1\nli", b"ne2\nline3", b""])
+        self.Patch(ssh.logger, "debug")
+        self.assertEqual(ssh._ReadOutput(self.created_subprocess, log_lines=True),
+                         b"line1\nline2\nline3")
+        ssh.logger.debug.assert_has_calls(
+            [mock.call(b"line1"), mock.call(b"line2"), mock.call(b"line3")])
+        self.created_subprocess.stdout.close.assert_called_once()
+
+    def testReadOutputTimeout(self):
+        """Test _ReadOutput kills the process once the timeout expires."""
+        self.Patch(select, "select", return_value=([], [], []))
+        self.Patch(os, "read", side_effect=[b"partial output", b""])
+        self.assertEqual(ssh._ReadOutput(self.created_subprocess, timeout=1),
+                         b"partial output")
+        self.created_subprocess.kill.assert_called_once()
+        self.assertEqual(select.select.call_count, 1)
+
+    def testSshCallWait(self):
+        """Test _SshCallWait waits for the command and returns its status."""
+        self.Patch(subprocess, "Popen", return_value=self.created_subprocess)
+        self.assertEqual(ssh._SshCallWait("fake cmd", timeout=1), 0)
+        self.created_subprocess.wait.assert_called()
+        self.created_subprocess.kill.assert_not_called()
+
+    def testSshLogOutputWithoutDebugLog(self):
+        """Test _SshLogOutput keeps the output unlogged if no handler emits it."""
+        self.Patch(subprocess, "Popen", return_value=self.created_subprocess)
+        self.Patch(ssh, "_IsDebugLogged", return_value=False)
+        self.Patch(ssh, "_ReadOutput", return_value=b"fake error")
+        self.created_subprocess.returncode = 1
+        self.assertRaises(subprocess.CalledProcessError,
+                          ssh._SshLogOutput, "fake cmd")
+        ssh._ReadOutput.assert_called_once_with(
+            self.created_subprocess, log_lines=False, timeout=None)
+
+    def testIsDebugLogged(self):
+        """Test _IsDebugLogged checks the handler levels."""
+        parent_logger = logging.getLogger("acloud_fake")
+        child_logger = logging.getLogger("acloud_fake.child")
+        handler = logging.NullHandler()
+        handler.setLevel(logging.INFO)
+        self.Patch(parent_logger, "handlers", [handler])
+        self.Patch(parent_logger, "propagate", False)
+        self.Patch(parent_logger, "level", logging.DEBUG)
+        self.assertFalse(ssh._IsDebugLogged(child_logger))
+        handler.setLevel(logging.DEBUG)
+        self.assertTrue(ssh._IsDebugLogged(child_logger))
+        self.Patch(child_logger, "propagate", False)
+        self.assertFalse(ssh._IsDebugLogged(child_logger))
+
+    def testGetControlPath(self):
+        """Test the control sockets are only kept in a private dir."""
+        temp_dir = tempfile.mkdtemp()
+        shared_dir = os.path.join(temp_dir, "shared")
+        private_dir = os.path.join(temp_dir, "private")
+        os.mkdir(shared_dir)
+        os.chmod(shared_dir, 0o755)
+        os.mkdir(private_dir)
+        os.chmod(private_dir, 0o700)
+        self.Patch(os, "makedirs", side_effect=OSError(errno.EEXIST, "File exists"))
+        self.Patch(ssh, "_SSH_CONTROL_DIR", shared_dir)
+        self.Patch(ssh, "_SSH_FALLBACK_CONTROL_DIR", private_dir)
+        try:
+            self.assertEqual(self._get_control_path(),
+                             os.path.join(private_dir, "%C"))
+            os.chmod(private_dir, 0o755)
+            self.assertIsNone(self._get_control_path())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def testGetBaseCmdWithoutControlPath(self):
+        """Test the base command doesn't share connections without a ControlPath."""
+        self.Patch(ssh, "_GetControlPath", return_value=None)
+        ssh_object = ssh.Ssh(self.FAKE_IP, self.FAKE_SSH_USER, self.FAKE_SSH_PRIVATE_KEY_PATH)
+        expected_ssh_cmd = ("/usr/bin/ssh -i /fake/acloud_rea -q -o UserKnownHostsFile=/dev/null "
+                            "-o StrictHostKeyChecking=no -l fake_user 1.1.1.1")
+        self.assertEqual(ssh_object.GetBaseCmd(constants.SSH_BIN), expected_ssh_cmd)
+
+    def testCheckSshConnectionWaitsForSemaphore(self):
+        """Test waiting for other connections to the target counts in the timeout."""
+        self.Patch(ssh, "_CONNECT_SEMAPHORES", {})
+        self.Patch(ssh, "_SshCallWait", return_value=0)
+        ssh_object = ssh.Ssh(self.FAKE_IP, self.FAKE_SSH_USER, self.FAKE_SSH_PRIVATE_KEY_PATH)
+        semaphore = ssh._GetConnectSemaphore("1.1.1.1")
+        self.assertIsNot(ssh._GetConnectSemaphore("2.2.2.2"), semaphore)
+        for _ in range(ssh._MAX_CONCURRENT_CONNECTS):
+            semaphore.acquire()
+        try:
+            self.assertRaises(errors.DeviceConnectionError,
+                              ssh_object.CheckSshConnection, 0.2)
+            ssh._SshCallWait.assert_not_called()
+        finally:
+            for _ in range(ssh._MAX_CONCURRENT_CONNECTS):
+                semaphore.release()
+
+        ssh_object.CheckSshConnection(10)
+        timeout = ssh._SshCallWait.call_args[0][1]
+        self.assertTrue(0 < timeout <= 10)
+
     def testGetBaseCmdWithInternalIP(self):
         """Test get base command with internal ip."""
         ssh_object = ssh.Ssh(ip=self.FAKE_IP,
@@ -62,20 +183,30 @@ class SshTest(driver_test_lib.BaseDriverTest):
                              ssh_private_key_path=self.FAKE_SSH_PRIVATE_KEY_PATH,
                              report_internal_ip=self.FAKE_REPORT_INTERNAL_IP)
         expected_ssh_cmd = ("/usr/bin/ssh -i /fake/acloud_rea -q -o UserKnownHostsFile=/dev/null "
-                            "-o StrictHostKeyChecking=no -l fake_user 10.1.1.1")
+                            "-o StrictHostKeyChecking=no "
+                            "-o ControlMaster=auto -o ControlPath=/fake/acloud_ssh/%C "
+                            "-o ControlPersist=120s "
+                            "-l fake_user 10.1.1.1")
         self.assertEqual(ssh_object.GetBaseCmd(constants.SSH_BIN), expected_ssh_cmd)
 
     def testGetBaseCmd(self):
         """Test get base command."""
         ssh_object = ssh.Ssh(self.FAKE_IP, self.FAKE_SSH_USER, self.FAKE_SSH_PRIVATE_KEY_PATH)
         expected_ssh_cmd = ("/usr/bin/ssh -i /fake/acloud_rea -q -o UserKnownHostsFile=/dev/null "
-                            "-o StrictHostKeyChecking=no -l fake_user 1.1.1.1")
+                            "-o StrictHostKeyChecking=no "
+                            "-o ControlMaster=auto -o ControlPath=/fake/acloud_ssh/%C "
+                            "-o ControlPersist=120s "
+                            "-l fake_user 1.1.1.1")
         self.assertEqual(ssh_object.GetBaseCmd(constants.SSH_BIN), expected_ssh_cmd)
 
         expected_scp_cmd = ("/usr/bin/scp -i /fake/acloud_rea -q -o UserKnownHostsFile=/dev/null "
-                            "-o StrictHostKeyChecking=no")
+                            "-o StrictHostKeyChecking=no "
+                            "-o ControlMaster=auto -o ControlPath=/fake/acloud_ssh/%C "
+                            "-o ControlPersist=120s")
         self.assertEqual(ssh_object.GetBaseCmd(constants.SCP_BIN), expected_scp_cmd)
 
+        self.assertRaises(errors.UnknownType, ssh_object.GetBaseCmd, "unknown_bin")
+
     # pylint: disable=no-member
     def testSshRunCmd(self):
         """Test ssh run command."""
@@ -83,7 +214,10 @@ class SshTest(driver_test_lib.BaseDriverTest):
         ssh_object = ssh.Ssh(self.FAKE_IP, self.FAKE_SSH_USER, self.FAKE_SSH_PRIVATE_KEY_PATH)
         ssh_object.Run("command")
         expected_cmd = ("exec /usr/bin/ssh -i /fake/acloud_rea -q -o UserKnownHostsFile=/dev/null "
-                        "-o StrictHostKeyChecking=no -l fake_user 1.1.1.1 command")
+                        "-o StrictHostKeyChecking=no "
+                        "-o ControlMaster=auto -o ControlPath=/fake/acloud_ssh/%C "
+                        "-o ControlPersist=120s "
+                        "-l fake_user 1.1.1.1 command")
         subprocess.Popen.assert_called_with(expected_cmd,
                                             shell=True,
                                             stderr=-2,
@@ -100,6 +234,8 @@ class SshTest(driver_test_lib.BaseDriverTest):
         ssh_object.Run("command")
         expected_cmd = ("exec /usr/bin/ssh -i /fake/acloud_rea -q -o UserKnownHostsFile=/dev/null "
                         "-o StrictHostKeyChecking=no "
+                        "-o ControlMaster=auto -o ControlPath=/fake/acloud_ssh/%C "
+                        "-o ControlPersist=120s "
                         "-o ProxyCommand='ssh fake_user@2.2.2.2 Server 22' "
                         "-l fake_user 1.1.1.1 command")
         subprocess.Popen.assert_called_with(expected_cmd,
@@ -113,10 +249,15 @@ class SshTest(driver_test_lib.BaseDriverTest):
         self.Patch(subprocess, "Popen", return_value=self.created_subprocess)
         ssh_object = ssh.Ssh(self.FAKE_IP, self.FAKE_SSH_USER, self.FAKE_SSH_PRIVATE_KEY_PATH)
         ssh_object.ScpPullFile("/tmp/test", "/tmp/test_1.log")
-        expected_cmd = ("exec /usr/bin/scp -i /fake/acloud_rea -q -o UserKnownHostsFile=/dev/null "
-                        "-o StrictHostKeyChecking=no fake_user@1.1.1.1:/tmp/test /tmp/test_1.log")
+        expected_cmd = ["/usr/bin/scp", "-i", "/fake/acloud_rea", "-q",
+                        "-o", "UserKnownHostsFile=/dev/null",
+                        "-o", "StrictHostKeyChecking=no",
+                        "-o", "ControlMaster=auto",
+                        "-o", "ControlPath=/fake/acloud_ssh/%C",
+                        "-o", "ControlPersist=120s",
+                        "fake_user@1.1.1.1:/tmp/test", "/tmp/test_1.log"]
         subprocess.Popen.assert_called_with(expected_cmd,
-                                            shell=True,
+                                            shell=False,
                                             stderr=-2,
                                             stdin=None,
                                             stdout=-1)
@@ -129,12 +270,16 @@ class SshTest(driver_test_lib.BaseDriverTest):
                              self.FAKE_SSH_PRIVATE_KEY_PATH,
                              self.FAKE_EXTRA_ARGS_SSH)
         ssh_object.ScpPullFile("/tmp/test", "/tmp/test_1.log")
-        expected_cmd = ("exec /usr/bin/scp -i /fake/acloud_rea -q -o UserKnownHostsFile=/dev/null "
-                        "-o StrictHostKeyChecking=no "
-                        "-o ProxyCommand='ssh fake_user@2.2.2.2 Server 22' "
-                        "fake_user@1.1.1.1:/tmp/test /tmp/test_1.log")
+        expected_cmd = ["/usr/bin/scp", "-i", "/fake/acloud_rea", "-q",
+                        "-o", "UserKnownHostsFile=/dev/null",
+                        "-o", "StrictHostKeyChecking=no",
+                        "-o", "ControlMaster=auto",
+                        "-o", "ControlPath=/fake/acloud_ssh/%C",
+                        "-o", "ControlPersist=120s",
+                        "-o", "ProxyCommand=ssh fake_user@2.2.2.2 Server 22",
+                        "fake_user@1.1.1.1:/tmp/test", "/tmp/test_1.log"]
         subprocess.Popen.assert_called_with(expected_cmd,
-                                            shell=True,
+                                            shell=False,
                                             stderr=-2,
                                             stdin=None,
                                             stdout=-1)
@@ -144,10 +289,15 @@ class SshTest(driver_test_lib.BaseDriverTest):
         self.Patch(subprocess, "Popen", return_value=self.created_subprocess)
         ssh_object = ssh.Ssh(self.FAKE_IP, self.FAKE_SSH_USER, self.FAKE_SSH_PRIVATE_KEY_PATH)
         ssh_object.ScpPushFile("/tmp/test", "/tmp/test_1.log")
-        expected_cmd = ("exec /usr/bin/scp -i /fake/acloud_rea -q -o UserKnownHostsFile=/dev/null "
-                        "-o StrictHostKeyChecking=no /tmp/test fake_user@1.1.1.1:/tmp/test_1.log")
+        expected_cmd = ["/usr/bin/scp", "-i", "/fake/acloud_rea", "-q",
+                        "-o", "UserKnownHostsFile=/dev/null",
+                        "-o", "StrictHostKeyChecking=no",
+                        "-o", "ControlMaster=auto",
+                        "-o", "ControlPath=/fake/acloud_ssh/%C",
+                        "-o", "ControlPersist=120s",
+                        "/tmp/test", "fake_user@1.1.1.1:/tmp/test_1.log"]
         subprocess.Popen.assert_called_with(expected_cmd,
-                                            shell=True,
+                                            shell=False,
                                             stderr=-2,
                                             stdin=None,
                                             stdout=-1)
@@ -160,16 +310,43 @@ class SshTest(driver_test_lib.BaseDriverTest):
                              self.FAKE_SSH_PRIVATE_KEY_PATH,
                              self.FAKE_EXTRA_ARGS_SSH)
         ssh_object.ScpPushFile("/tmp/test", "/tmp/test_1.log")
-        expected_cmd = ("exec /usr/bin/scp -i /fake/acloud_rea -q -o UserKnownHostsFile=/dev/null "
-                        "-o StrictHostKeyChecking=no "
-                        "-o ProxyCommand='ssh fake_user@2.2.2.2 Server 22' "
-                        "/tmp/test fake_user@1.1.1.1:/tmp/test_1.log")
+        expected_cmd = ["/usr/bin/scp", "-i", "/fake/acloud_rea", "-q",
+                        "-o", "UserKnownHostsFile=/dev/null",
+                        "-o", "StrictHostKeyChecking=no",
+                        "-o", "ControlMaster=auto",
+                        "-o", "ControlPath=/fake/acloud_ssh/%C",
+                        "-o", "ControlPersist=120s",
+                        "-o", "ProxyCommand=ssh fake_user@2.2.2.2 Server 22",
+                        "/tmp/test", "fake_user@1.1.1.1:/tmp/test_1.log"]
         subprocess.Popen.assert_called_with(expected_cmd,
-                                            shell=True,
+                                            shell=False,
                                             stderr=-2,
                                             stdin=None,
                                             stdout=-1)
 
+    def testScpPushFilesCmd(self):
+        """Test scp push files in one command."""
+        self.Patch(subprocess, "Popen", return_value=self.created_subprocess)
+        ssh_object = ssh.Ssh(self.FAKE_IP, self.FAKE_SSH_USER, self.FAKE_SSH_PRIVATE_KEY_PATH)
+        ssh_object.ScpPushFiles(["/tmp/test1", "/tmp/test2"], "/tmp/dst")
+        self.assertEqual(subprocess.Popen.call_count, 1)
+        self.assertEqual(subprocess.Popen.call_args[0][0][-3:],
+                         ["/tmp/test1", "/tmp/test2", "fake_user@1.1.1.1:/tmp/dst"])
+
+    def testScpPullFilesCmd(self):
+        """Test scp pull files split into batches of limited length."""
+        self.Patch(subprocess, "Popen", return_value=self.created_subprocess)
+        ssh_object = ssh.Ssh(self.FAKE_IP, self.FAKE_SSH_USER, self.FAKE_SSH_PRIVATE_KEY_PATH)
+        base_length = len(ssh_object.GetBaseCmd(constants.SCP_BIN) + " /tmp/dst")
+        self.Patch(ssh, "_SCP_MAX_CMD_LENGTH", base_length + 60)
+        ssh_object.ScpPullFiles(["/tmp/test1", "/tmp/test2", "/tmp/test3"], "/tmp/dst")
+        self.assertEqual(subprocess.Popen.call_count, 2)
+        self.assertEqual(subprocess.Popen.call_args_list[0][0][0][-3:],
+                         ["fake_user@1.1.1.1:/tmp/test1", "fake_user@1.1.1.1:/tmp/test2",
+                          "/tmp/dst"])
+        self.assertEqual(subprocess.Popen.call_args_list[1][0][0][-2:],
+                         ["fake_user@1.1.1.1:/tmp/test3", "/tmp/dst"])
+
     # pylint: disable=protected-access
     def testIPAddress(self):
         """Test IP class to get ip address."""
@@ -202,12 +379,69 @@ class SshTest(driver_test_lib.BaseDriverTest):
                              ssh_private_key_path=self.FAKE_SSH_PRIVATE_KEY_PATH,
                              report_internal_ip=self.FAKE_REPORT_INTERNAL_IP)
         self.Patch(ssh, "_SshCall", return_value=-1)
+        self.Patch(ssh, "_SshCallWait", return_value=-1)
         self.assertRaises(errors.DeviceConnectionError,
                           ssh_object.WaitForSsh,
                           timeout=1,
                           sleep_for_retry=1,
                           max_retry=1)
 
+    def testWaitForSshFastFailure(self):
+        """Test WaitForSsh doesn't retry fast failures more than max_retry times."""
+        ssh_object = ssh.Ssh(ip=self.FAKE_IP,
+                             user=self.FAKE_SSH_USER,
+                             ssh_private_key_path=self.FAKE_SSH_PRIVATE_KEY_PATH)
+        self.Patch(ssh.Ssh, "CheckSshConnection",
+                   side_effect=errors.DeviceConnectionError)
+        start_time = time.time()
+        # Backoff sleeps are 0.01 + 0.02 + ... + 0.05 secs.
+        self.assertRaises(errors.DeviceConnectionError,
+                          ssh_object.WaitForSsh,
+                          timeout=10,
+                          sleep_for_retry=0.01,
+                          max_retry=5)
+        self.assertEqual(ssh.Ssh.CheckSshConnection.call_count, 6)
+        self.assertGreaterEqual(time.time() - start_time, 0.14)
+        self.assertLess(time.time() - start_time, 1)
+
+    def testWaitForSshSlowProbe(self):
+        """Test WaitForSsh overlaps a slow probe with the next one."""
+        ssh_object = ssh.Ssh(ip=self.FAKE_IP,
+                             user=self.FAKE_SSH_USER,
+                             ssh_private_key_path=self.FAKE_SSH_PRIVATE_KEY_PATH)
+        first_probe_done = threading.Event()
+
+        def _CheckSshConnection(_timeout):
+            """The first probe hangs until another one connects."""
+            if ssh.Ssh.CheckSshConnection.call_count == 1:
+                first_probe_done.wait(5)
+                raise errors.DeviceConnectionError
+            first_probe_done.set()
+
+        self.Patch(ssh.Ssh, "CheckSshConnection", side_effect=_CheckSshConnection)
+        start_time = time.time()
+        ssh_object.WaitForSsh(timeout=0.4, sleep_for_retry=10, max_retry=2)
+        self.assertEqual(ssh.Ssh.CheckSshConnection.call_count, 2)
+        self.assertLess(time.time() - start_time, 1)
+
+    def testWaitForSshUnexpectedError(self):
+        """Test WaitForSsh raises errors other than connection failures."""
+        ssh_object = ssh.Ssh(ip=self.FAKE_IP,
+                             user=self.FAKE_SSH_USER,
+                             ssh_private_key_path=self.FAKE_SSH_PRIVATE_KEY_PATH)
+        self.Patch(ssh.Ssh, "CheckSshConnection", side_effect=OSError("fake error"))
+        self.assertRaises(OSError, ssh_object.WaitForSsh, max_retry=1)
+        self.assertEqual(ssh.Ssh.CheckSshConnection.call_count, 1)
+
+    def testWaitForSshReady(self):
+        """Test WaitForSsh returns once one of the probes connects."""
+        ssh_object = ssh.Ssh(ip=self.FAKE_IP,
+                             user=self.FAKE_SSH_USER,
+                             ssh_private_key_path=self.FAKE_SSH_PRIVATE_KEY_PATH)
+        self.Patch(ssh.Ssh, "CheckSshConnection",
+                   side_effect=[errors.DeviceConnectionError, None, None])
+        ssh_object.WaitForSsh(timeout=3, sleep_for_retry=0, max_retry=2)
+        self.assertTrue(ssh.Ssh.CheckSshConnection.call_count >= 2)
 
 if __name__ == "__main__":
     unittest.main()
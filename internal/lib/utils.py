@@ -101,6 +101,8 @@ _EvaluatedResult = collections.namedtuple("EvaluatedResult",
 _SUPPORTED_SYSTEMS_AND_DISTS = {"Linux": ["Ubuntu", "Debian"]}
 _DEFAULT_TIMEOUT_ERR = "Function did not complete within %d secs."
 _SSVNC_VIEWER_PATTERN = "vnc://127.0.0.1:%(vnc_port)d"
+# Cache of execution filename to its path, filled in by FindExecutable.
+_EXECUTABLE_PATHS = {}
 
 
 class TempDir(object):
@@ -1239,13 +1241,20 @@ def GetBuildEnvironmentVariable(variable_name):
 def FindExecutable(filename):
     """A compatibility function to find execution file path.
 
+    Found paths are cached, so $PATH is only scanned once for each file.
+
     Args:
         filename: String of execution filename.
 
     Returns:
         String: execution file path.
     """
-    return find_executable(filename) if six.PY2 else shutil.which(filename)
+    if filename not in _EXECUTABLE_PATHS:
+        bin_path = find_executable(filename) if six.PY2 else shutil.which(filename)
+        if not bin_path:
+            return None
+        _EXECUTABLE_PATHS[filename] = bin_path
+    return _EXECUTABLE_PATHS[filename]
 
 
 def GetDictItems(namedtuple_object):
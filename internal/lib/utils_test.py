@@ -427,6 +427,20 @@ class UtilsTest(driver_test_lib.BaseDriverTest):
         utils.CleanupSSVncviewer(fake_vnc_port)
         subprocess.check_call.assert_not_called()
 
+    # pylint: disable=protected-access
+    def testFindExecutable(self):
+        """test FindExecutable only scans $PATH until the file is found."""
+        self.Patch(utils, "_EXECUTABLE_PATHS", {})
+        find_bin = mock.MagicMock(side_effect=[None, "/bin/fake", "/bin/other"])
+        if six.PY2:
+            self.Patch(utils, "find_executable", find_bin)
+        else:
+            self.Patch(shutil, "which", find_bin)
+        self.assertIsNone(utils.FindExecutable("fake"))
+        self.assertEqual(utils.FindExecutable("fake"), "/bin/fake")
+        self.assertEqual(utils.FindExecutable("fake"), "/bin/fake")
+        self.assertEqual(find_bin.call_count, 2)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -43,11 +43,15 @@ TODO:
 
 """
 
+import errno
+import hashlib
+import io
 import logging
+import operator
 import os
+import tempfile
 
-import six
-
+from google.protobuf import message
 from google.protobuf import text_format
 
 # pylint: disable=no-name-in-module,import-error
@@ -63,14 +67,24 @@ logger = logging.getLogger(__name__)
 _CONFIG_DATA_PATH = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "data")
 _DEFAULT_CONFIG_FILE = "acloud.config"
+# Parsed config messages keyed by (path, mtime, size, message type).
+_CONFIG_CACHE = {}
+# Binary copies of text configs, they're much faster to parse. They're kept
+# per user since the installed config may be extracted anew on every run.
+_BINARY_CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".config", "acloud",
+                                  "config_cache")
+_BINARY_CONFIG_FILE = "%(message_name)s-%(digest)s.pb"
 
 
 def GetDefaultConfigFile():
     """Return path to default config file."""
     config_path = os.path.join(os.path.expanduser("~"), ".config", "acloud")
     # Create the default config dir if it doesn't exist.
-    if not os.path.exists(config_path):
+    try:
         os.makedirs(config_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
     return os.path.join(config_path, _DEFAULT_CONFIG_FILE)
 
 
@@ -96,6 +110,7 @@ class AcloudConfig(object):
         "machine_type", "network", "min_machine_size",
         "disk_image_name", "disk_image_mime_type"
     ]
+    _REQUIRED_FIELD_GETTER = operator.attrgetter(*REQUIRED_FIELD)
 
     # pylint: disable=too-many-statements
     def __init__(self, usr_cfg, internal_cfg):
@@ -124,38 +139,25 @@ class AcloudConfig(object):
         self.ssh_private_key_path = usr_cfg.ssh_private_key_path
         self.ssh_public_key_path = usr_cfg.ssh_public_key_path
         self.storage_bucket_name = usr_cfg.storage_bucket_name
-        self.metadata_variable = {
-            key: val for key, val in
-            six.iteritems(internal_cfg.default_usr_cfg.metadata_variable)
-        }
+        self.metadata_variable = dict(
+            internal_cfg.default_usr_cfg.metadata_variable)
         self.metadata_variable.update(usr_cfg.metadata_variable)
 
-        self.device_resolution_map = {
-            device: resolution for device, resolution in
-            six.iteritems(internal_cfg.device_resolution_map)
-        }
-        self.device_default_orientation_map = {
-            device: orientation for device, orientation in
-            six.iteritems(internal_cfg.device_default_orientation_map)
-        }
-        self.no_project_access_msg_map = {
-            project: msg for project, msg in
-            six.iteritems(internal_cfg.no_project_access_msg_map)
-        }
+        # Read-only maps are used as is, without copying them into dicts.
+        self.device_resolution_map = internal_cfg.device_resolution_map
+        self.device_default_orientation_map = dict(
+            internal_cfg.device_default_orientation_map)
+        self.no_project_access_msg_map = internal_cfg.no_project_access_msg_map
         self.min_machine_size = internal_cfg.min_machine_size
         self.disk_image_name = internal_cfg.disk_image_name
         self.disk_image_mime_type = internal_cfg.disk_image_mime_type
         self.disk_image_extension = internal_cfg.disk_image_extension
         self.disk_raw_image_name = internal_cfg.disk_raw_image_name
         self.disk_raw_image_extension = internal_cfg.disk_raw_image_extension
-        self.valid_branch_and_min_build_id = {
-            branch: min_build_id for branch, min_build_id in
-            six.iteritems(internal_cfg.valid_branch_and_min_build_id)
-        }
-        self.precreated_data_image_map = {
-            size_gb: image_name for size_gb, image_name in
-            six.iteritems(internal_cfg.precreated_data_image)
-        }
+        self.valid_branch_and_min_build_id = (
+            internal_cfg.valid_branch_and_min_build_id)
+        self.precreated_data_image_map = dict(
+            internal_cfg.precreated_data_image)
         self.extra_data_disk_size_gb = (
             usr_cfg.extra_data_disk_size_gb or
             internal_cfg.default_usr_cfg.extra_data_disk_size_gb)
@@ -230,28 +232,68 @@ class AcloudConfig(object):
         Args:
             parsed_args: Args parsed from command line.
         """
-        if parsed_args.which == create_args.CMD_CREATE and parsed_args.spec:
+        self._OverrideCommon(parsed_args)
+        override = self._OVERRIDE_BY_COMMAND.get(parsed_args.which)
+        if override:
+            override(self, parsed_args)
+
+    def _OverrideCommon(self, parsed_args):
+        """Override configuration values shared by all commands.
+
+        Args:
+            parsed_args: Args parsed from command line.
+        """
+        if parsed_args.email:
+            self.service_account_name = parsed_args.email
+        if parsed_args.service_account_json_private_key_path:
+            self.service_account_json_private_key_path = (
+                parsed_args.service_account_json_private_key_path)
+
+    def _OverrideCreate(self, parsed_args):
+        """Override configuration values for the create command.
+
+        Args:
+            parsed_args: Args parsed from command line.
+        """
+        if parsed_args.spec:
             if not self.resolution:
                 self.resolution = self.device_resolution_map.get(
                     parsed_args.spec, "")
             if not self.orientation:
                 self.orientation = self.device_default_orientation_map.get(
                     parsed_args.spec, "")
-        if parsed_args.email:
-            self.service_account_name = parsed_args.email
-        if parsed_args.service_account_json_private_key_path:
-            self.service_account_json_private_key_path = (
-                parsed_args.service_account_json_private_key_path)
-        if parsed_args.which == "create_gf" and parsed_args.base_image:
-            self.stable_goldfish_host_image_name = parsed_args.base_image
-        if parsed_args.which == create_args.CMD_CREATE and not self.hw_property:
+        if not self.hw_property:
             flavor = parsed_args.flavor or constants.FLAVOR_PHONE
             self.hw_property = self.common_hw_property_map.get(flavor, "")
-        if parsed_args.which in [create_args.CMD_CREATE, "create_cf"]:
-            if parsed_args.network:
-                self.network = parsed_args.network
-            if parsed_args.multi_stage_launch is not None:
-                self.enable_multi_stage = parsed_args.multi_stage_launch
+        # create takes the same network and launch args as create_cf.
+        self._OverrideCreateCf(parsed_args)
+
+    def _OverrideCreateGf(self, parsed_args):
+        """Override configuration values for the create_gf command.
+
+        Args:
+            parsed_args: Args parsed from command line.
+        """
+        if parsed_args.base_image:
+            self.stable_goldfish_host_image_name = parsed_args.base_image
+
+    def _OverrideCreateCf(self, parsed_args):
+        """Override configuration values for the create_cf command.
+
+        Args:
+            parsed_args: Args parsed from command line.
+        """
+        if parsed_args.network:
+            self.network = parsed_args.network
+        if parsed_args.multi_stage_launch is not None:
+            self.enable_multi_stage = parsed_args.multi_stage_launch
+
+    # Command specific overrides, keyed by parsed_args.which.
+    _OVERRIDE_BY_COMMAND = {
+        create_args.CMD_CREATE: _OverrideCreate,
+        "create_gf": _OverrideCreateGf,
+        "create_cf": _OverrideCreateCf,
+    }
 
     def OverrideHwPropertyWithFlavor(self, flavor):
         """Override hw configuration values with flavor name.
@@ -267,7 +309,8 @@ class AcloudConfig(object):
 
     def Verify(self):
         """Verify configuration fields."""
-        missing = [f for f in self.REQUIRED_FIELD if not getattr(self, f)]
+        values = self._REQUIRED_FIELD_GETTER(self)
+        missing = [f for f, v in zip(self.REQUIRED_FIELD, values) if not v]
         if missing:
             raise errors.ConfigError(
                 "Missing required configuration fields: %s" % missing)
@@ -315,30 +358,117 @@ class AcloudConfigManager(object):
         internal_cfg = None
         usr_cfg = None
         try:
-            with open(self._internal_config_path) as config_file:
-                internal_cfg = self.LoadConfigFromProtocolBuffer(
-                    config_file, internal_config_pb2.InternalConfig)
+            internal_cfg = self.LoadConfigFromPath(
+                self._internal_config_path, internal_config_pb2.InternalConfig,
+                binary_cache=True)
         except OSError as e:
             raise errors.ConfigError("Could not load config files: %s" % str(e))
         # Load user config file
         if self.user_config_path:
-            if os.path.exists(self.user_config_path):
-                with open(self.user_config_path, "r") as config_file:
-                    usr_cfg = self.LoadConfigFromProtocolBuffer(
-                        config_file, user_config_pb2.UserConfig)
-            else:
+            try:
+                usr_cfg = self.LoadConfigFromPath(
+                    self.user_config_path, user_config_pb2.UserConfig)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
                 raise errors.ConfigError("The file doesn't exist: %s" %
                                          (self.user_config_path))
         else:
             self.user_config_path = GetDefaultConfigFile()
-            if os.path.exists(self.user_config_path):
-                with open(self.user_config_path, "r") as config_file:
-                    usr_cfg = self.LoadConfigFromProtocolBuffer(
-                        config_file, user_config_pb2.UserConfig)
-            else:
+            try:
+                usr_cfg = self.LoadConfigFromPath(
+                    self.user_config_path, user_config_pb2.UserConfig)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
                 usr_cfg = user_config_pb2.UserConfig()
         return AcloudConfig(usr_cfg, internal_cfg)
 
+    @classmethod
+    def LoadConfigFromPath(cls, config_path, message_type, binary_cache=False):
+        """Load config from a text-based protocol buffer file path.
+
+        The parsed config is cached until the file changes, so loading the
+        same config again in this process skips parsing the text.
+
+        Args:
+            config_path: String, path to the config file.
+            message_type: A proto message class.
+            binary_cache: Boolean, True to keep a binary copy of the config
+                          next to the file for later processes to load.
+
+        Returns:
+            An instance of type "message_type" populated with data
+            from the file.
+        """
+        config_stat = os.stat(config_path)
+        cache_key = (config_path, config_stat.st_mtime, config_stat.st_size,
+                     message_type)
+        if cache_key not in _CONFIG_CACHE:
+            if binary_cache:
+                _CONFIG_CACHE[cache_key] = cls._LoadConfigWithBinaryCache(
+                    config_path, message_type)
+            else:
+                with open(config_path, "r") as config_file:
+                    _CONFIG_CACHE[cache_key] = cls.LoadConfigFromProtocolBuffer(
+                        config_file, message_type)
+        # Hand out a copy so callers can't modify the cached config.
+        config = message_type()
+        config.CopyFrom(_CONFIG_CACHE[cache_key])
+        return config
+
+    @classmethod
+    def _LoadConfigWithBinaryCache(cls, config_path, message_type):
+        """Load config from its binary copy, or create the copy if missing.
+
+        The binary copy is named by the digest of the text config it was made
+        from, so it's only used for the exact same text config.
+        Failing to write it (e.g. read-only home dir) is not an error, the
+        text config is just parsed again next time.
+
+        Args:
+            config_path: String, path to the text config file.
+            message_type: A proto message class.
+
+        Returns:
+            An instance of type "message_type" populated with data
+            from the file.
+        """
+        with open(config_path, "rb") as config_file:
+            config_text = config_file.read()
+        binary_path = os.path.join(_BINARY_CONFIG_DIR, _BINARY_CONFIG_FILE % {
+            "message_name": message_type.DESCRIPTOR.name,
+            "digest": hashlib.sha1(config_text).hexdigest()})
+        try:
+            with open(binary_path, "rb") as binary_file:
+                config = message_type()
+                config.ParseFromString(binary_file.read())
+                return config
+        except (IOError, OSError, message.DecodeError) as e:
+            logger.debug("Binary config %s isn't usable: %s", binary_path, e)
+
+        config = cls.LoadConfigFromProtocolBuffer(
+            io.StringIO(config_text.decode("utf-8")), message_type)
+        temp_path = None
+        try:
+            try:
+                os.makedirs(_BINARY_CONFIG_DIR)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # Write to a temp file first so other processes never read a
+            # partially written binary config.
+            temp_fd, temp_path = tempfile.mkstemp(suffix=".tmp",
+                                                  dir=_BINARY_CONFIG_DIR)
+            with os.fdopen(temp_fd, "wb") as temp_file:
+                temp_file.write(config.SerializeToString())
+            os.rename(temp_path, binary_path)
+        except (IOError, OSError) as e:
+            logger.debug("Failed to write binary config %s: %s", binary_path, e)
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+        return config
+
     @staticmethod
     def LoadConfigFromProtocolBuffer(config_file, message_type):
         """Load config from a text-based protocol buffer file.
@@ -15,8 +15,10 @@
 # limitations under the License.
 
 """Tests for acloud.public.config."""
+import errno
 import unittest
 import os
+import shutil
 import tempfile
 import mock
 
@@ -145,9 +147,9 @@ common_hw_property_map {
         self.assertEqual(cfg.extra_scopes, ["scope1", "scope2"])
 
     # pylint: disable=protected-access
+    @mock.patch.object(config, "_BINARY_CONFIG_DIR", "/fake/config_cache")
     @mock.patch("os.makedirs")
-    @mock.patch("os.path.exists")
-    def testLoadUserConfigLogic(self, mock_file_exist, _mock_makedirs):
+    def testLoadUserConfigLogic(self, _mock_makedirs):
         """Test load user config logic.
 
         Load user config with some special design.
@@ -156,22 +158,28 @@ common_hw_property_map {
         2. User didn't specify user config, use default config:
             If default config didn't exist: Initialize empty data.
         """
-        config_specify = config.AcloudConfigManager(self.config_file)
-        self.config_file.read.return_value = self.USER_CONFIG
-        self.assertEqual(config_specify.user_config_path, self.config_file)
-        mock_file_exist.return_value = False
+        temp_dir = tempfile.mkdtemp()
+        missing_cfg_file_path = os.path.join(temp_dir, "missing.config")
+        config_specify = config.AcloudConfigManager(missing_cfg_file_path)
+        self.assertEqual(config_specify.user_config_path, missing_cfg_file_path)
         with self.assertRaises(errors.ConfigError):
             config_specify.Load()
         # Test default config
-        config_unspecify = config.AcloudConfigManager(None)
-        cfg = config_unspecify.Load()
-        self.assertEqual(config_unspecify.user_config_path,
-                         config.GetDefaultConfigFile())
-        self.assertEqual(cfg.project, "")
-        self.assertEqual(cfg.zone, "")
+        default_patcher = mock.patch.object(config, "GetDefaultConfigFile",
+                                            return_value=missing_cfg_file_path)
+        default_patcher.start()
+        try:
+            config_unspecify = config.AcloudConfigManager(None)
+            cfg = config_unspecify.Load()
+            self.assertEqual(config_unspecify.user_config_path,
+                             missing_cfg_file_path)
+            self.assertEqual(cfg.project, "")
+            self.assertEqual(cfg.zone, "")
+        finally:
+            shutil.rmtree(temp_dir)
+            default_patcher.stop()
 
         # Test default user config exist
-        mock_file_exist.return_value = True
         # Write the config data into a tmp file and have GetDefaultConfigFile
         # return that.
         _, temp_cfg_file_path = tempfile.mkstemp()
@@ -192,6 +200,93 @@ common_hw_property_map {
             os.remove(temp_cfg_file_path)
             default_patcher.stop()
 
+    @mock.patch("os.makedirs")
+    def testGetDefaultConfigFile(self, mock_makedirs):
+        """Test GetDefaultConfigFile tolerates an existing config dir."""
+        mock_makedirs.side_effect = OSError(errno.EEXIST, "File exists")
+        self.assertTrue(config.GetDefaultConfigFile().endswith("acloud.config"))
+        mock_makedirs.side_effect = OSError(errno.EACCES, "Permission denied")
+        with self.assertRaises(OSError):
+            config.GetDefaultConfigFile()
+
+    @mock.patch.object(config, "_CONFIG_CACHE", {})
+    def testLoadConfigFromPath(self):
+        """Test config is only parsed again after the file changes."""
+        _, temp_cfg_file_path = tempfile.mkstemp()
+        parse_patcher = mock.patch.object(
+            config.AcloudConfigManager, "LoadConfigFromProtocolBuffer",
+            wraps=config.AcloudConfigManager.LoadConfigFromProtocolBuffer)
+        mock_parse = parse_patcher.start()
+        try:
+            with open(temp_cfg_file_path, "w") as cfg_file:
+                cfg_file.writelines(self.USER_CONFIG)
+            cfg = config.AcloudConfigManager.LoadConfigFromPath(
+                temp_cfg_file_path, user_config_pb2.UserConfig)
+            cfg.project = "modified-project"
+            cfg = config.AcloudConfigManager.LoadConfigFromPath(
+                temp_cfg_file_path, user_config_pb2.UserConfig)
+            self.assertEqual(cfg.project, "fake-project")
+            self.assertEqual(mock_parse.call_count, 1)
+
+            with open(temp_cfg_file_path, "w") as cfg_file:
+                cfg_file.writelines('project: "new-project"')
+            cfg = config.AcloudConfigManager.LoadConfigFromPath(
+                temp_cfg_file_path, user_config_pb2.UserConfig)
+            self.assertEqual(cfg.project, "new-project")
+            self.assertEqual(mock_parse.call_count, 2)
+        finally:
+            os.remove(temp_cfg_file_path)
+            parse_patcher.stop()
+
+    @mock.patch.object(config, "_CONFIG_CACHE", {})
+    def testLoadConfigFromPathBinaryCache(self):
+        """Test config is loaded from its binary copy once it's written."""
+        temp_dir = tempfile.mkdtemp()
+        temp_cfg_file_path = os.path.join(temp_dir, "default.config")
+        cache_dir = os.path.join(temp_dir, "config_cache")
+        cache_patcher = mock.patch.object(config, "_BINARY_CONFIG_DIR", cache_dir)
+        cache_patcher.start()
+        parse_patcher = mock.patch.object(
+            config.AcloudConfigManager, "LoadConfigFromProtocolBuffer",
+            wraps=config.AcloudConfigManager.LoadConfigFromProtocolBuffer)
+        mock_parse = parse_patcher.start()
+        try:
+            with open(temp_cfg_file_path, "w") as cfg_file:
+                cfg_file.writelines(self.INTERNAL_CONFIG)
+            cfg = config.AcloudConfigManager.LoadConfigFromPath(
+                temp_cfg_file_path, internal_config_pb2.InternalConfig,
+                binary_cache=True)
+            self.assertEqual(cfg.min_machine_size, "n1-standard-1")
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertEqual(mock_parse.call_count, 1)
+
+            # The copy is found again for the same config at another path,
+            # like a config extracted to a new dir on each run.
+            os.rename(temp_cfg_file_path, temp_cfg_file_path + ".new")
+            config._CONFIG_CACHE.clear()
+            cfg = config.AcloudConfigManager.LoadConfigFromPath(
+                temp_cfg_file_path + ".new", internal_config_pb2.InternalConfig,
+                binary_cache=True)
+            self.assertEqual(cfg.min_machine_size, "n1-standard-1")
+            self.assertEqual(cfg.user_agent, "fake_user_agent")
+            self.assertEqual(mock_parse.call_count, 1)
+
+            # A changed config never loads the copy of the old one.
+            with open(temp_cfg_file_path, "w") as cfg_file:
+                cfg_file.writelines('min_machine_size: "n1-standard-2"')
+            config._CONFIG_CACHE.clear()
+            cfg = config.AcloudConfigManager.LoadConfigFromPath(
+                temp_cfg_file_path, internal_config_pb2.InternalConfig,
+                binary_cache=True)
+            self.assertEqual(cfg.min_machine_size, "n1-standard-2")
+            self.assertEqual(mock_parse.call_count, 2)
+            self.assertTrue(all(name.endswith(".pb")
+                                for name in os.listdir(cache_dir)))
+        finally:
+            shutil.rmtree(temp_dir)
+            parse_patcher.stop()
+            cache_patcher.stop()
+
     def testLoadInternalConfig(self):
         """Test loading internal config."""
         self.config_file.read.return_value = self.INTERNAL_CONFIG
@@ -260,6 +355,24 @@ common_hw_property_map {
             config.AcloudConfigManager.LoadConfigFromProtocolBuffer(
                 self.config_file, internal_config_pb2.InternalConfig)
 
+    def testVerify(self):
+        """Test Verify reports missing required fields."""
+        self.config_file.read.return_value = self.INTERNAL_CONFIG
+        internal_cfg = config.AcloudConfigManager.LoadConfigFromProtocolBuffer(
+            self.config_file, internal_config_pb2.InternalConfig)
+        self.config_file.read.return_value = self.USER_CONFIG
+        usr_cfg = config.AcloudConfigManager.LoadConfigFromProtocolBuffer(
+            self.config_file, user_config_pb2.UserConfig)
+        cfg = config.AcloudConfig(usr_cfg, internal_cfg)
+        cfg.Verify()
+
+        cfg.network = ""
+        cfg.disk_image_name = None
+        with self.assertRaises(errors.ConfigError) as context:
+            cfg.Verify()
+        self.assertIn("network", str(context.exception))
+        self.assertIn("disk_image_name", str(context.exception))
+
     def testOverrideWithHWProperty(self):
         """Test override hw property by flavor type."""
         # initial config with test config.
@@ -288,6 +401,32 @@ common_hw_property_map {
         cfg.OverrideWithArgs(args)
         self.assertEqual(cfg.hw_property, "")
 
+    def testOverrideWithArgsByCommand(self):
+        """Test only the overrides of the given command are applied."""
+        self.config_file.read.return_value = self.INTERNAL_CONFIG
+        internal_cfg = config.AcloudConfigManager.LoadConfigFromProtocolBuffer(
+            self.config_file, internal_config_pb2.InternalConfig)
+        self.config_file.read.return_value = self.USER_CONFIG
+        usr_cfg = config.AcloudConfigManager.LoadConfigFromProtocolBuffer(
+            self.config_file, user_config_pb2.UserConfig)
+        cfg = config.AcloudConfig(usr_cfg, internal_cfg)
+
+        args = mock.MagicMock()
+        args.which = "create_gf"
+        args.email = "fake@email.com"
+        args.base_image = "fake-base-image"
+        args.network = "fake-network"
+        cfg.OverrideWithArgs(args)
+        self.assertEqual(cfg.service_account_name, "fake@email.com")
+        self.assertEqual(cfg.stable_goldfish_host_image_name, "fake-base-image")
+        self.assertEqual(cfg.network, "default")
+
+        args.which = "create_cf"
+        args.multi_stage_launch = True
+        cfg.OverrideWithArgs(args)
+        self.assertEqual(cfg.network, "fake-network")
+        self.assertTrue(cfg.enable_multi_stage)
+
 
 if __name__ == "__main__":
     unittest.main()
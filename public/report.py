@@ -199,12 +199,15 @@ class Report(object):
             status=self.status,
             errors=self.errors,
             data=self.data)
-        logger.info("Report: %s", json.dumps(result, indent=2, sort_keys=True))
+        # Serialize once for both the log and the file, and write it in one go
+        # instead of the many small writes json.dump() does.
+        report_json = json.dumps(result, indent=2, sort_keys=True)
+        logger.info("Report: %s", report_json)
         if not report_file:
             return
         try:
             with open(report_file, "w") as f:
-                json.dump(result, f, indent=2, sort_keys=True)
+                f.write(report_json)
             logger.info("Report file generated at %s",
                         os.path.abspath(report_file))
         except OSError as e:
@@ -16,7 +16,12 @@
 
 """Tests for acloud.public.report."""
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
+
 from acloud.public import report
 
 
@@ -91,5 +96,24 @@ class ReportTest(unittest.TestCase):
         self.assertEqual(test_report.errors, ["some errors"])
 
 
+    def testDump(self):
+        """test Dump writes the report file."""
+        test_report = report.Report("create")
+        test_report.AddData("devices", {"instance_name": "instance_1"})
+        temp_dir = tempfile.mkdtemp()
+        report_file = os.path.join(temp_dir, "report.json")
+        try:
+            test_report.Dump(report_file)
+            with open(report_file, "r") as f:
+                self.assertEqual(json.load(f), {
+                    "command": "create",
+                    "status": "UNKNOWN",
+                    "errors": [],
+                    "data": {"devices": [{"instance_name": "instance_1"}]}
+                })
+        finally:
+            shutil.rmtree(temp_dir)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -77,9 +77,7 @@ def PullLogs(ssh, log_files, download_folder):
         log_files: List of file path in the remote instance.
         download_folder: String of download folder path.
     """
-    for log_file in log_files:
-        target_file = os.path.join(download_folder, os.path.basename(log_file))
-        ssh.ScpPullFile(log_file, target_file)
+    ssh.ScpPullFiles(log_files, download_folder)
     _DisplayPullResult(download_folder)
 
 
@@ -62,7 +62,7 @@ class PullTest(driver_test_lib.BaseDriverTest):
         log_files = ["file1.log", "file2.log"]
         download_folder = "/fake_folder"
         pull.PullLogs(_ssh, log_files, download_folder)
-        self.assertEqual(_ssh.ScpPullFile.call_count, 2)
+        _ssh.ScpPullFiles.assert_called_once_with(log_files, download_folder)
         utils.PrintColorString.assert_called_once()
 
     @mock.patch.object(ssh.Ssh, "Run")